@@ -2,15 +2,28 @@
 """A wrapper around unison.
 Organised into: Basic logging, Remote utilities, Main programs
 """
+import itertools
+import json
+import mmap
+import os
 import re
+import shlex
 import shutil
+import stat
 import sys
+import tarfile
+import time
 import typing
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from datetime import datetime
+from functools import cached_property
 from pathlib import Path, PurePosixPath, PureWindowsPath
-from subprocess import check_output
-from urllib.parse import urlparse
+from subprocess import DEVNULL, PIPE, CalledProcessError, Popen, call, check_call, check_output
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 WRAPPER_NAME = 'uwrapper'
 
@@ -33,33 +46,153 @@ class bcolors:
     UNDERLINE = '\033[4m'
 
 
-def _color_msg(msg, color):
-    return f'{color}{msg}{bcolors.ENDC}'
+# No ANSI codes when the output is redirected to a file or a pipe. error() writes to stderr,
+# which is often redirected separately (e.g. 2>log), so each stream is checked on its own.
+_USE_COLOR = sys.stdout.isatty()
+_USE_COLOR_STDERR = sys.stderr.isatty()
+
+
+def _prefix(tag, color, use_color=_USE_COLOR):
+    return f'{color}{tag} ' if use_color else f'{tag} '
+
+
+# Precomputed once, so that each log call is a single concatenation and a single write
+# (which also keeps lines from the concurrent local/remote phases from interleaving).
+_ERROR_PREFIX = _prefix(f'[{WRAPPER_NAME} ERROR]', bcolors.FAIL_RED, _USE_COLOR_STDERR)
+_INFO_PREFIX = _prefix(f'[{WRAPPER_NAME}]', bcolors.OK_GREEN)
+_WARN_PREFIX = _prefix(f'[{WRAPPER_NAME} WARN]', bcolors.WARN_YELLOW)
+_SUFFIX = f'{bcolors.ENDC}\n' if _USE_COLOR else '\n'
+_ERROR_SUFFIX = f'{bcolors.ENDC}\n' if _USE_COLOR_STDERR else '\n'
 
 
 def error(msg):
-    print(
-        _color_msg(f'[{WRAPPER_NAME} ERROR] {msg}', bcolors.FAIL_RED),
-        file=sys.stderr
-    )
+    sys.stderr.write(_ERROR_PREFIX + msg + _ERROR_SUFFIX)
 
 
 def info(msg):
-    print(_color_msg(f'[{WRAPPER_NAME}] {msg}', bcolors.OK_GREEN))
+    sys.stdout.write(_INFO_PREFIX + msg + _SUFFIX)
 
 
 def warn(msg):
-    print(_color_msg(f'[{WRAPPER_NAME} WARN] {msg}', bcolors.WARN_YELLOW))
+    sys.stdout.write(_WARN_PREFIX + msg + _SUFFIX)
 
 
 # %% ------------------------------------------------------------------------
 # %% Remote utilities
+SSH_BACKEND_ENV = 'UWRAPPER_SSH_BACKEND'
+# Set to a non-empty value to ignore the cached facts and probe the remote again.
+NO_CACHE_ENV = 'UWRAPPER_NO_CACHE'
+# Facts about each remote (its home folder) that rarely change.
+REMOTE_CACHE_FILE = Path('~/.cache/uwrapper/remotes.json').expanduser()
+REMOTE_CACHE_TTL = 24 * 60 * 60  # seconds
+
+
+def _read_cached_facts(remote_name: str, keys: typing.Iterable[str]) -> typing.Optional[dict]:
+    if os.environ.get(NO_CACHE_ENV):
+        return None
+    try:
+        entry = json.loads(REMOTE_CACHE_FILE.read_text(encoding='utf-8'))[remote_name]
+        if time.time() - entry['time'] < REMOTE_CACHE_TTL and all(k in entry for k in keys):
+            return entry
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def _load_cache() -> dict:
+    try:
+        cache = json.loads(REMOTE_CACHE_FILE.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def _write_cached_facts(remote_name: str, facts: typing.Optional[dict]):
+    """Stores the facts of remote_name, or drops them if facts is None."""
+    cache = _load_cache()
+    if facts is None:
+        if cache.pop(remote_name, None) is None:
+            return
+    else:
+        cache[remote_name] = {**facts, 'time': time.time()}
+    try:
+        REMOTE_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        REMOTE_CACHE_FILE.write_text(json.dumps(cache, indent=2), encoding='utf-8')
+    except OSError as e:
+        warn(f'Failed to write the cache file "{REMOTE_CACHE_FILE}": {e}')
+
+
+def _pipe(producer: typing.List[str], consumer: typing.List[str]):
+    """Runs "producer | consumer", raising CalledProcessError if either side fails."""
+    upstream = Popen(producer, stdout=PIPE)
+    try:
+        downstream_code = call(consumer, stdin=upstream.stdout)
+    finally:
+        upstream.stdout.close()  # so that the producer gets SIGPIPE if the consumer died
+        upstream_code = upstream.wait()
+    if upstream_code != 0:
+        raise CalledProcessError(upstream_code, producer)
+    if downstream_code != 0:
+        raise CalledProcessError(downstream_code, consumer)
+
+
+def _posix_sh(script: str) -> str:
+    """Wraps a POSIX shell script into a single command for ssh.
+
+    ssh runs its command through the user's login shell, which may be fish or tcsh, where
+    assignments, "if ...; then ... fi" or "!" mean something else or nothing.
+    """
+    return 'sh -c ' + shlex.quote(script)
+
+
+def _is_nonempty_dir(path: Path) -> bool:
+    # Stops at the first entry, without building Path objects for the others.
+    try:
+        with os.scandir(path) as it:
+            return next(it, None) is not None
+    except (FileNotFoundError, NotADirectoryError):
+        return False
 
 
 class RemoteSSH:
     def __init__(self, remote_name: str):
         self.remote_name = remote_name
 
+    @cached_property
+    def _ssh_opts(self) -> typing.List[str]:
+        # All ssh/scp calls of one run share a multiplexed connection, so that only the
+        # first call pays for the handshake. ControlPersist keeps the master alive between
+        # calls and close() stops it when the run ends; "%C" hashes the connection
+        # parameters, giving each destination its own socket.
+        # ssh does not create the folder of ControlPath itself.
+        Path('~/.ssh').expanduser().mkdir(mode=0o700, exist_ok=True)
+        return [
+            '-o', 'ControlMaster=auto', '-o', 'ControlPath=~/.ssh/uwrapper-%C',
+            '-o', 'ControlPersist=60s',
+        ]
+
+    def close(self):
+        """Stops the multiplexing master connection, if one was started."""
+        if '_ssh_opts' not in self.__dict__:  # no ssh call was made
+            return
+        call(
+            ['ssh', *self._ssh_opts, '-O', 'exit', self.remote_name],
+            stdout=DEVNULL, stderr=DEVNULL
+        )
+
+    def _lookup_facts(self, query: typing.Callable[[], dict]) -> dict:
+        """Returns the facts about the remote (at least 'home'), only calling query (and ssh)
+        on a cache miss. query returns all the facts in a single remote call.
+        """
+        keys = self._fact_keys
+        facts = _read_cached_facts(self.remote_name, keys)
+        if facts is None:
+            facts = query()
+            _write_cached_facts(self.remote_name, facts)
+        return facts
+
+    _fact_keys = ('home',)
+
     @property
     def remote_unison(self) -> str:
         raise NotImplementedError(type(self))
@@ -68,129 +201,155 @@ class RemoteSSH:
     def remote_backup(self) -> str:
         raise NotImplementedError(type(self))
 
-    def unison_exists(self) -> bool:
-        raise NotImplementedError(type(self))
+    def backup_remote_unison(self) -> typing.Tuple[bool, bool]:
+        """In a single remote call: checks whether the remote unison folder and its backup exist,
+        and moves the folder to the backup when only the former exists.
 
-    def unison_backup_exists(self) -> bool:
+        Returns (unison_existed, unison_backup_existed), i.e. the state before the move.
+        """
         raise NotImplementedError(type(self))
 
-    def move_remote_unison_to_backup(self):
-        raise NotImplementedError(type(self))
+    def _check_backup_state(self, unison_existed: bool, backup_existed: bool, moved: bool):
+        if unison_existed and not backup_existed and not moved:
+            raise RuntimeError(
+                f'Failed to move "{self.remote_unison}" to "{self.remote_backup}"'
+                f' on remote "{self.remote_name}"'
+            )
 
-    def move_remote_backup_to_unison(self):
-        raise NotImplementedError(type(self))
+    def restore_remote_unison(self) -> bool:
+        """In a single remote call: deletes the remote unison folder, and moves the backup back in
+        its place if there is one.
 
-    def create_remote_unison_dir(self):
+        Returns whether a backup was restored.
+        """
         raise NotImplementedError(type(self))
 
+    def _check_restore_state(self, result: str) -> bool:
+        if result == 'rmfail':
+            raise RuntimeError(
+                f'Failed to remove "{self.remote_unison}" on remote "{self.remote_name}"'
+            )
+        if result == 'mvfail':
+            raise RuntimeError(
+                f'Failed to move "{self.remote_backup}" to "{self.remote_unison}"'
+                f' on remote "{self.remote_name}"'
+            )
+        return result == 'restored'
+
     def copy_archive_folder_to_remote_unison(self, archive_folder: Path):
         raise NotImplementedError(type(self))
 
     def copy_remote_archives_back(self, archive_folder: Path):
         raise NotImplementedError(type(self))
 
-    def delete_remote_unison(self):
-        raise NotImplementedError(type(self))
-
 
 class RemoteSSHUnix(RemoteSSH):
-    def __init__(self, remote_name):
-        super().__init__(remote_name)
-        self.remote_home = PurePosixPath(self.execute('echo $HOME').strip())
-        self._remote_unison = self.remote_home / '.unison'
-        self._remote_backup = self.remote_home / UNISON_BACKUP_NAME
+    def _query_facts(self) -> dict:
+        return {'home': self.execute('echo "$HOME"').strip()}
 
-    @property
+    @cached_property
+    def _facts(self) -> dict:
+        return self._lookup_facts(self._query_facts)
+
+    @cached_property
+    def remote_home(self) -> PurePosixPath:
+        return PurePosixPath(self._facts['home'])
+
+    @cached_property
+    def _remote_unison(self) -> PurePosixPath:
+        return self.remote_home / '.unison'
+
+    @cached_property
+    def _remote_backup(self) -> PurePosixPath:
+        return self.remote_home / UNISON_BACKUP_NAME
+
+    @cached_property
     def remote_unison(self):
         return str(self._remote_unison)
 
-    @property
+    @cached_property
     def remote_backup(self):
         return str(self._remote_backup)
 
+    # Shell-quoted forms, for embedding in remote commands.
+    @cached_property
+    def _unison_q(self) -> str:
+        return shlex.quote(self.remote_unison)
+
+    @cached_property
+    def _backup_q(self) -> str:
+        return shlex.quote(self.remote_backup)
+
     def execute(self, cmd: str):
-        """Note: this command surround cmd with single quotes.
+        """Note: cmd is passed to ssh as a single argument, without going through a local shell.
 
         If an error happens, the remote error message is shown in stderr, and check_output
         throws a CalledProcessError but without the remote error message.
         """
-        return check_output(f"ssh {self.remote_name} -T '{cmd}'",
-                            shell=True).decode('utf-8')
-
-    def _path_exists(self, path: PurePosixPath) -> bool:
-        ret = self.execute(f'test -e "{path}" && echo "yes" || echo "no"')
-        ret = ret.strip()
-        if ret == "yes":
-            return True
-        elif ret == "no":
-            return False
-        else:
-            raise RuntimeError(
-                f'When testing path existence, got unexpected output from ssh: {ret}'
-            )
-
-    def _mkdir(self, path: PurePosixPath):
-        self.execute(f'mkdir -p "{path}"')
-        if not self._path_exists(path):
-            raise RuntimeError(
-                f'Failed to create "{path}" on remote "{self.remote_name}"'
-            )
-
-    def _move(self, old_path: PurePosixPath, new_path: PurePosixPath):
-        self.execute(f'mv "{old_path}" "{new_path}"')
-        if not self._path_exists(old_path) and self._path_exists(new_path):
-            return
-        else:
-            raise RuntimeError(
-                f'Failed to move "{old_path}" to "{new_path}" on remote "{self.remote_name}"'
-            )
+        return check_output(
+            ['ssh', *self._ssh_opts, '-T', self.remote_name, cmd],
+            encoding='utf-8', errors='replace'
+        )
 
     def _dir_local2remote(
             self, local_path: Path, remote_path: PurePosixPath
     ):
-        # Note:
-        # - we don't use rsync, since rsync requires a remote installation as well.
-        # -  we add "-O" option to scp, so that we are compatible when the remote ssh does
-        #    not have implement SFTP protocol.
-        check_output(
-            f'scp -O -r "{local_path}" "{self.remote_name}:{remote_path}"',
-            shell=True
+        # tar streams the whole folder through one ssh pipe, instead of scp's per-file transfers.
+        # It copies the content of local_path into remote_path.
+        dst = shlex.quote(str(remote_path))
+        _pipe(
+            ['tar', '-C', str(local_path), '-cf', '-', '.'],
+            ['ssh', *self._ssh_opts, '-T', self.remote_name,
+             f'mkdir -p {dst} && tar -C {dst} -xf -'],
         )
-        if not self._path_exists(remote_path):
-            raise RuntimeError(
-                f'Failed to copy "{local_path}" to "{remote_path}" in remote "{self.remote_name}".'
-            )
+        # _pipe checks the exit status of each side, so remote_path is known to exist now.
 
     def _dir_remote2local(
             self, remote_path: PurePosixPath, local_path: Path
     ):
-        check_output(
-            f'scp -O -r "{self.remote_name}:{remote_path}" "{local_path}"',
-            shell=True
+        local_path.mkdir(parents=True, exist_ok=True)
+        _pipe(
+            ['ssh', *self._ssh_opts, '-T', self.remote_name,
+             f'tar -C {shlex.quote(str(remote_path))} -cf - .'],
+            ['tar', '-C', str(local_path), '-xf', '-'],
         )
 
-    def unison_exists(self):
-        return self._path_exists(self._remote_unison)
-
-    def unison_backup_exists(self):
-        return self._path_exists(self._remote_backup)
-
-    def move_remote_unison_to_backup(self):
-        self._move(self._remote_unison, self._remote_backup)
-
-    def move_remote_backup_to_unison(self):
-        self._move(self._remote_backup, self._remote_unison)
-
-    def create_remote_unison_dir(self):
-        self._mkdir(self._remote_unison)
+    def backup_remote_unison(self):
+        u, b = self._unison_q, self._backup_q
+        ret = self.execute(_posix_sh(
+            f'test -e {u} && u="yes" || u="no"; test -e {b} && b="yes" || b="no"; m="skip";'
+            f' if [ "$u" = "yes" ] && [ "$b" = "no" ]; then'
+            f' mv {u} {b} && test -e {b} && ! test -e {u} && m="yes" || m="no"; fi;'
+            ' echo "$u $b $m"'
+        ))
+        flags = ret.split()
+        if len(flags) != 3 or any(f not in ('yes', 'no', 'skip') for f in flags):
+            raise RuntimeError(
+                f'When probing the remote state, got unexpected output from ssh: {ret}'
+            )
+        unison_existed, backup_existed = flags[0] == 'yes', flags[1] == 'yes'
+        self._check_backup_state(unison_existed, backup_existed, flags[2] == 'yes')
+        return unison_existed, backup_existed
+
+    def restore_remote_unison(self):
+        u, b = self._unison_q, self._backup_q
+        ret = self.execute(_posix_sh(
+            f'rm -rf {u}; if test -e {u}; then echo "rmfail"; elif test -e {b}; then'
+            f' mv {b} {u} && test -e {u} && ! test -e {b} && echo "restored" || echo "mvfail";'
+            ' else echo "deleted"; fi'
+        )).strip()
+        if ret not in ('restored', 'deleted', 'rmfail', 'mvfail'):
+            raise RuntimeError(
+                f'When restoring the remote state, got unexpected output from ssh: {ret}'
+            )
+        return self._check_restore_state(ret)
 
     def copy_archive_folder_to_remote_unison(self, archive_folder: Path):
         self._dir_local2remote(archive_folder, self._remote_unison)
 
     def copy_remote_archives_back(self, archive_folder: Path):
         self._dir_remote2local(self._remote_unison, archive_folder)
-        if archive_folder.exists() and archive_folder.is_dir(
-        ) and any(archive_folder.iterdir()):
+        if _is_nonempty_dir(archive_folder):
             return
         else:
             raise RuntimeError(
@@ -198,35 +357,120 @@ class RemoteSSHUnix(RemoteSSH):
                 f' Check local folder {archive_folder} and the remote "{self.remote_name}".'
             )
 
-    def delete_remote_unison(self):
-        self.execute(f'rm -rf {self.remote_unison}')
-        if self._path_exists(self._remote_unison):
-            raise RuntimeError(f'Failed to remove "{self.remote_unison}" on remote "{self.remote_name}"')
 
+class RemoteSSHParamiko(RemoteSSHUnix):
+    """A Unix remote driven through one in-process paramiko connection.
+
+    All commands are channels on the same transport, and directories are streamed as a single
+    tar archive over such a channel, instead of spawning one ssh/scp process per call.
+    """
 
-class RemoteSSHWindows(RemoteSSH):
     def __init__(self, remote_name):
         super().__init__(remote_name)
-        self._remote_home = self._find_home()
-        self._remote_unison = self._remote_home / '.unison'
-        self._remote_backup = self._remote_home / UNISON_BACKUP_NAME
+        try:
+            import paramiko  # noqa: F401
+        except ImportError:
+            raise RuntimeError(
+                f'{SSH_BACKEND_ENV}=paramiko requires paramiko: pip install paramiko'
+            ) from None
+        self._client = None
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
 
     @property
+    def client(self):
+        if self._client is None:
+            import paramiko
+            user, _, alias = self.remote_name.rpartition('@')
+            config = paramiko.SSHConfig()
+            config_file = Path('~/.ssh/config').expanduser()
+            if config_file.exists():
+                config = paramiko.SSHConfig.from_path(str(config_file))
+            host = config.lookup(alias)
+            client = paramiko.SSHClient()
+            client.load_system_host_keys()
+            client.connect(
+                host['hostname'],
+                port=int(host.get('port', 22)),
+                username=user or host.get('user'),
+                key_filename=host.get('identityfile'),
+            )
+            client.get_transport().set_keepalive(30)
+            self._client = client
+        return self._client
+
+    @staticmethod
+    def _check_exit(cmd: str, stdout, stderr, output=b''):
+        status = stdout.channel.recv_exit_status()
+        if status != 0:
+            raise CalledProcessError(status, cmd, output, stderr.read())
+
+    def execute(self, cmd: str):
+        """Same contract as RemoteSSHUnix.execute, raising CalledProcessError on failure."""
+        _, stdout, stderr = self.client.exec_command(cmd)
+        output = stdout.read()
+        self._check_exit(cmd, stdout, stderr, output)
+        return output.decode('utf-8', errors='replace')
+
+    def _dir_local2remote(
+            self, local_path: Path, remote_path: PurePosixPath
+    ):
+        dst = shlex.quote(str(remote_path))
+        cmd = f'mkdir -p {dst} && tar -C {dst} -xf -'
+        stdin, stdout, stderr = self.client.exec_command(cmd)
+        with tarfile.open(fileobj=stdin, mode='w|') as tar:
+            tar.add(str(local_path), arcname='.')
+        stdin.channel.shutdown_write()
+        self._check_exit(cmd, stdout, stderr)
+
+    def _dir_remote2local(
+            self, remote_path: PurePosixPath, local_path: Path
+    ):
+        cmd = f'tar -C {shlex.quote(str(remote_path))} -cf - .'
+        _, stdout, stderr = self.client.exec_command(cmd)
+        local_path.mkdir(parents=True, exist_ok=True)
+        with tarfile.open(fileobj=stdout, mode='r|') as tar:
+            if hasattr(tarfile, 'data_filter'):
+                tar.extractall(str(local_path), filter='data')
+            else:
+                tar.extractall(str(local_path))
+        self._check_exit(cmd, stdout, stderr)
+
+
+class RemoteSSHWindows(RemoteSSH):
+    @cached_property
+    def remote_home(self) -> PureWindowsPath:
+        return PureWindowsPath(self._lookup_facts(lambda: {'home': self._find_home()})['home'])
+
+    @cached_property
+    def _remote_unison(self) -> PureWindowsPath:
+        return self.remote_home / '.unison'
+
+    @cached_property
+    def _remote_backup(self) -> PureWindowsPath:
+        return self.remote_home / UNISON_BACKUP_NAME
+
+    @cached_property
     def remote_unison(self):
         return str(self._remote_unison)
 
-    @property
+    @cached_property
     def remote_backup(self):
         return str(self._remote_backup)
 
     def execute(self, cmd: str):
-        """Note: this command surround cmd with single quotes.
+        """Note: cmd is passed to ssh as a single argument, without going through a local shell.
 
         If an error happens, the remote error message is shown in stderr, and check_output
         throws a CalledProcessError but without the remote error message.
         """
         return check_output(
-            f"ssh {self.remote_name} -T '{cmd}'", shell=True).decode('utf-8')
+            ['ssh', *self._ssh_opts, '-T', self.remote_name, cmd],
+            encoding='utf-8', errors='replace'
+        )
 
     def support_powershell(self):
         output = self.execute("echo $PSVersionTable")
@@ -234,65 +478,48 @@ class RemoteSSHWindows(RemoteSSH):
 
     def _find_home(self):
         output = self.execute("echo $env:USERPROFILE")
-        output = output.strip()  # strip newline characters
-        return PureWindowsPath(output)
-
-    def _path_exists(self, path: PureWindowsPath):
-        cmd = f"Test-Path -Path \"{path}\""
-        output = self.execute(cmd).strip()
-        if output == 'True':
-            return True
-        elif output == 'False':
-            return False
-        else:
+        return output.strip()  # strip newline characters
+
+    def backup_remote_unison(self):
+        u, b = self._remote_unison, self._remote_backup
+        output = self.execute(
+            f'$u = Test-Path -Path "{u}"; $b = Test-Path -Path "{b}"; $m = "skip";'
+            f' if ($u -and -not $b) {{ Rename-Item -Path "{u}" -NewName "{b}";'
+            f' $m = (Test-Path -Path "{b}") -and -not (Test-Path -Path "{u}") }};'
+            ' "$u $b $m"'
+        )
+        flags = output.split()[-3:]  # Rename-Item errors, if any, come before
+        if len(flags) != 3 or any(f not in ('True', 'False', 'skip') for f in flags):
             raise ValueError(output)
-
-    def _mkdir(self, path: PureWindowsPath):
-        self.execute(f'New-Item -Path "{path}" -ItemType Directory')
-        if not self._path_exists(path):
-            raise RuntimeError(f'Failed to create "{path}" on "{self.remote_name}"')
-
-    def _move(self, old: PureWindowsPath, new: PureWindowsPath):
-        self.execute(f'Rename-Item -Path "{old}" -NewName "{new}"')
-        if self._path_exists(new) and not self._path_exists(old):
-            return
-        else:
-            raise RuntimeError(f'Failed to move "{old}" to "{new}" on "{self.remote_name}"')
-
-    def unison_exists(self):
-        return self._path_exists(self._remote_unison)
-
-    def unison_backup_exists(self):
-        return self._path_exists(self._remote_backup)
-
-    def move_remote_unison_to_backup(self):
-        self._move(self._remote_unison, self._remote_backup)
-
-    def move_remote_backup_to_unison(self):
-        self._move(self._remote_backup, self._remote_unison)
-
-    def create_remote_unison_dir(self):
-        self._mkdir(self._remote_unison)
+        unison_existed, backup_existed = flags[0] == 'True', flags[1] == 'True'
+        self._check_backup_state(unison_existed, backup_existed, flags[2] == 'True')
+        return unison_existed, backup_existed
+
+    def restore_remote_unison(self):
+        u, b = self._remote_unison, self._remote_backup
+        output = self.execute(
+            f'Remove-Item -Path "{u}" -Recurse; if (Test-Path -Path "{u}") {{ "rmfail" }}'
+            f' elseif (Test-Path -Path "{b}") {{ Rename-Item -Path "{b}" -NewName "{u}";'
+            f' if ((Test-Path -Path "{u}") -and -not (Test-Path -Path "{b}")) {{ "restored" }}'
+            ' else { "mvfail" } } else { "deleted" }'
+        )
+        result = output.split()[-1:]  # Remove-Item/Rename-Item errors, if any, come before
+        if not result or result[0] not in ('restored', 'deleted', 'rmfail', 'mvfail'):
+            raise ValueError(output)
+        return self._check_restore_state(result[0])
 
     def copy_archive_folder_to_remote_unison(self, archive_folder: Path):
-        return check_output(
-            f'scp -r "{archive_folder}" "{self.remote_name}:{self._remote_unison}"',
-            shell=True
-        ).decode('utf-8')
+        check_call([
+            'scp', '-r', *self._ssh_opts, str(archive_folder),
+            f'{self.remote_name}:{self._remote_unison}'
+        ], stdout=DEVNULL)
 
     def copy_remote_archives_back(self, archive_folder: Path):
         # test shows that \ -> / substitution is necessary, otherwise scp reports "No such file or directory"
         remote_path = str(self._remote_unison).replace('\\', '/')
-        return check_output(
-            f'scp -r "{self.remote_name}:{remote_path}" "{archive_folder}"',
-            shell=True
-        ).decode('utf-8')
-
-    def delete_remote_unison(self):
-        # -Recurse for folders
-        self.execute(f'Remove-Item -Path "{self._remote_unison}" -Recurse')
-        if self.unison_exists():
-            raise RuntimeError(f'Failed to remove "{self._remote_unison}" on "{self.remote_name}"')
+        check_call([
+            'scp', '-r', *self._ssh_opts, f'{self.remote_name}:{remote_path}', str(archive_folder)
+        ], stdout=DEVNULL)
 
 
 # %% ------------------------------------------------------------------------
@@ -300,6 +527,12 @@ class RemoteSSHWindows(RemoteSSH):
 UNISON_BACKUP_NAME = f'.unison_before_{WRAPPER_NAME}'
 LOCAL_ARC_NAME = 'archives_local'
 REMOTE_ARC_NAME = 'archives_remote'
+# The local home is fixed for the lifetime of the process, so it is resolved once.
+_HOME = Path.home()
+_U_FOLDER = _HOME / '.unison'
+_U_BACKUP_FOLDER = _HOME / UNISON_BACKUP_NAME
+# For clean-ups that the user does not need to wait for; joined at the end of main().
+_bg_pool = ThreadPoolExecutor(max_workers=2)
 
 
 @dataclass
@@ -321,48 +554,71 @@ class Profile:
     remote_ssh: typing.Optional[RemoteSSH]
 
 
+# Horizontal whitespace only: with re.MULTILINE, '\s' would let a match run across lines.
+_ROOT_RE = re.compile(rb'^root[ \t]*=[ \t]*(.+)$', re.MULTILINE)
+# Below this size, reading the file is cheaper than setting up a memory map.
+MMAP_MIN_SIZE = 4096
+
+
+def _match_root_lines(content):
+    """Yields the matches of _ROOT_RE on the lines of content (bytes or an mmap) starting with
+    "root".
+
+    The candidate lines are located with content.find, which runs in C, so the regex is never
+    tried on the other lines.
+    """
+    if content[:4] == b'root':
+        m = _ROOT_RE.match(content, 0)
+        if m:
+            yield m
+    pos = content.find(b'\nroot')
+    while pos >= 0:
+        m = _ROOT_RE.match(content, pos + 1)
+        if m:
+            yield m
+        pos = content.find(b'\nroot', pos + 1)
+
+
+def _read_root_specs(profile_file: Path) -> typing.List[str]:
+    # The file is scanned as bytes, and only the matched roots are decoded.
+    with profile_file.open('rb') as f:
+        if os.fstat(f.fileno()).st_size < MMAP_MIN_SIZE:
+            return _decode_roots(_match_root_lines(f.read()))
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return _decode_roots(_match_root_lines(mm))
+
+
+def _decode_roots(matches) -> typing.List[str]:
+    # A valid profile has exactly 2 roots, so the scan stops at a third: that is enough for
+    # read_profile to reject the file.
+    # rstrip() also drops the '\r' of CRLF line endings
+    return [m.group(1).decode('utf-8').rstrip() for m in itertools.islice(matches, 3)]
+
+
+# ssh://<host>/<path>, where <path> is either absolute Unix (group 2) or starts with a drive (group 3).
+_SSH_RE = re.compile(r'ssh://([^/]+)/(?:(/.*)|([A-Za-z]:.*))', re.DOTALL)
+
+
+def _parse_root_path(path: str) -> Root:
+    if not path.startswith('ssh://'):
+        if '://' in path:  # e.g. socket://, which is not supported
+            raise ValueError(f"Failed to understand this root: {path}")
+        return Root(path, True)
+    m = _SSH_RE.fullmatch(path)
+    if m is None:
+        raise ValueError(f"Failed to understand this root: {path}")
+    name, unix_path, windows_path = m.groups()
+    if unix_path is not None:
+        return Root(unix_path, False, name, 'Unix')
+    return Root(windows_path, False, name, 'Windows')
+
+
 def read_profile(profile_file: Path) -> Profile:
     if not profile_file.name.endswith('.prf'):
         raise RuntimeError(
             f'Profile file did not end with the extension .prf: {profile_file}'
         )
-    content = profile_file.read_text(encoding='utf-8')
-    root_pattern = re.compile(r'^root\s*=\s*(.+)$')
-    assert not root_pattern.match('root=')
-    assert root_pattern.match('root=asdf').groups() == ('asdf',)
-    assert root_pattern.match('root  =  asdf').groups() == ('asdf',)
-
-    def parse_root_path(path: str):
-        parsed = urlparse(path)
-        if parsed.scheme == '':
-            return Root(path, True)
-        if parsed.scheme == 'ssh':
-            name = parsed.netloc
-            if parsed.path.startswith('//'):
-                return Root(parsed.path[1:], False, name, 'Unix')
-            if parsed.path[0] == '/' and parsed.path[1].isalpha() and parsed.path[2] == ':':
-                return Root(parsed.path[1:], False, name, 'Windows')
-        raise ValueError(f"Failed to understand this root: {path}")
-
-    assert parse_root_path('/home/xx/') == Root('/home/xx/', True)
-    assert parse_root_path('ssh://remote//home/xx/') == Root('/home/xx/', False, 'remote', 'Unix')
-    assert parse_root_path('ssh://wr/d:\\Users\\hc\\code\\') == Root('d:\\Users\\hc\\code\\', False, 'wr', 'Windows')
-
-    roots = []
-    for line in content.split('\n'):
-        m = root_pattern.match(line)
-        if m:
-            root_spec = m.groups()[0]
-            roots.append(parse_root_path(root_spec))
-            # if root_spec.startswith('ssh://'):
-            #     is_local = False
-            #     root_spec = root_spec[6:]
-            #     remote_name = root_spec[:root_spec.find('/')]
-            #     path = root_spec[root_spec.find('/') + 1:]
-            #     roots.append(Root(path, is_local, remote_name))
-            # else:
-            #     path = root_spec
-            #     roots.append(Root(path, True, None))
+    roots = [_parse_root_path(root_spec) for root_spec in _read_root_specs(profile_file)]
     if len(roots) != 2:
         raise RuntimeError(f'Invalid root specification. Found these roots: {roots}')
 
@@ -376,7 +632,10 @@ def read_profile(profile_file: Path) -> Profile:
         remote_name = remote_root.remote_name
         assert remote_name is not None
         if remote_root.remote_type == 'Unix':
-            remote_shell = RemoteSSHUnix(remote_name)
+            if os.environ.get(SSH_BACKEND_ENV) == 'paramiko':
+                remote_shell = RemoteSSHParamiko(remote_name)
+            else:
+                remote_shell = RemoteSSHUnix(remote_name)
         elif remote_root.remote_type == 'Windows':
             remote_shell = RemoteSSHWindows(remote_name)
         else:
@@ -402,9 +661,9 @@ def read_profile(profile_file: Path) -> Profile:
 
 def start(profile: Profile):
     # Check for local .unison, rename to a backup if exists.
-    u_folder = Path('~/.unison').expanduser()
+    u_folder = _U_FOLDER
     if u_folder.exists():
-        u_backup_folder = Path(f'~/{UNISON_BACKUP_NAME}').expanduser()
+        u_backup_folder = _U_BACKUP_FOLDER
         if u_backup_folder.exists():
             error(
                 f'Found existing backup folder "{u_backup_folder}" while "{u_folder}" exists!'
@@ -415,112 +674,248 @@ def start(profile: Profile):
         info(f'Existing "{u_folder}" is moved to "{u_backup_folder}"')
 
     if profile.contain_remote:
-        # Check for remote folder status.
+        # Check for remote folder status, in one round-trip.
         # If both unison and the backup exists: unexpected and quit.
         # If both are missing: good.
-        # If only unison folder: move to "backup". If only the backup: good.
+        # If only unison folder: moved to "backup". If only the backup: good.
         remote_ssh = profile.remote_ssh
-        if remote_ssh.unison_exists():
-            if remote_ssh.unison_backup_exists():
+        unison_exists, unison_backup_exists = remote_ssh.backup_remote_unison()
+        if unison_exists:
+            if unison_backup_exists:
                 error(
                     f'On "{profile.remote_name}", found existing remote backup '
                     f'folder "{remote_ssh.remote_backup}" while "{remote_ssh.remote_unison}" exists!'
                     "\nThis is unexpected. Check why! Quit."
                 )
                 return -1
-            # else (not unison_backup_exists):
-            remote_ssh.move_remote_unison_to_backup()
+            # else (not unison_backup_exists): it has been moved to the backup.
             info(
                 f'Existing "{remote_ssh.remote_unison}" on "{profile.remote_name}"'
                 f' is moved to "{remote_ssh.remote_backup}"'
             )
 
     # Main program
-    backup_f = profile.data_folder / 'archives_backup' / datetime.today().strftime('%Y%m%d')
-
-    # Copy local archives to .unison
-    local_archive_f = profile.data_folder / LOCAL_ARC_NAME
-    if not local_archive_f.exists():
-        info(f'No local archive files found.')
-        u_folder.mkdir()  # creates empty ~/.unison
-    else:
-        # move all files under local to .unison
-        shutil.copytree(local_archive_f, u_folder)
-        info(f'Copied archives in "{local_archive_f}" to "{u_folder}"')
-        backup_f.mkdir(parents=True, exist_ok=True)
-        backup_f_local_archive = backup_f / LOCAL_ARC_NAME
-        if backup_f_local_archive.exists():
-            shutil.rmtree(backup_f_local_archive)
-        shutil.move(local_archive_f, backup_f_local_archive)
-        info(f'Moved archives in "{local_archive_f}" to "{backup_f_local_archive}" (backup)')
-
+    # The local copy is disk-bound and the remote one network-bound, so they are overlapped.
+    tasks = [lambda: _start_local_archives(profile, u_folder)]
     if profile.contain_remote:
-        # Copy target archives to remote's .unison
-        remote_archive_f = profile.data_folder / REMOTE_ARC_NAME
-        if not remote_archive_f.exists():
-            info(f'No remote archive files found.')
-            # Note: note need to create an empty remote unison directory here.
-        else:
-            # move all files under remote to .unison
-            remote_ssh = profile.remote_ssh
-            remote_ssh.copy_archive_folder_to_remote_unison(remote_archive_f)
-            info(f'Copied remote archive in "{remote_archive_f}" to'
-                 f' "{remote_ssh.remote_unison}" on "{profile.remote_name}"')
-            backup_f.mkdir(parents=True, exist_ok=True)
-            backup_f_remote_archive = backup_f / REMOTE_ARC_NAME
-            if backup_f_remote_archive.exists():
-                shutil.rmtree(backup_f_remote_archive)
-            shutil.move(remote_archive_f, backup_f_remote_archive)
-            info(f'Moved archives in "{remote_archive_f}" to "{backup_f_remote_archive}" (backup)')
+        tasks.append(lambda: _start_remote_archives(profile))
+    copied = _run_in_parallel(*tasks)
+    # Only once both copies succeeded: after a failure, both archive folders are left in place.
+    backup_f = profile.data_folder / 'archives_backup' / time.strftime('%Y%m%d')
+    for archive_f in copied:
+        if archive_f is not None:
+            _backup_archives(archive_f, backup_f)
 
     shutil.copy(profile.cfg_file, u_folder / profile.cfg_file.name)
     info(f'Copied profile "{profile.cfg_file}" to "{u_folder}"')
     info(f"DONE. Please run: unison {profile.cfg_file.name}")
 
 
+def _run_in_parallel(*tasks: typing.Callable[[], typing.Any]) -> list:
+    """Runs independent tasks concurrently, and returns their results once all finished.
+
+    Re-raises the first error, so that the caller does not go on with any of the results.
+    """
+    if len(tasks) == 1:
+        return [tasks[0]()]
+    with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+        futures = [executor.submit(task) for task in tasks]
+    return [future.result() for future in futures]
+
+
+# ioctl request number of FICLONE, from <linux/fs.h>.
+_FICLONE = 0x40049409
+_CAN_CLONE = fcntl is not None and sys.platform.startswith('linux')
+
+
+def _same_fs(a: Path, b: Path) -> bool:
+    return os.stat(a).st_dev == os.stat(b).st_dev
+
+
+def _copy_file(src, dst):
+    """A copy_function for shutil.copytree, which hints the kernel that the source is read
+    sequentially and copies it in-kernel with copy_file_range. Falls back to shutil.copy2.
+    """
+    if not hasattr(os, 'copy_file_range'):
+        return shutil.copy2(src, dst)
+    try:
+        with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+            fd_src, fd_dst = f_src.fileno(), f_dst.fileno()
+            os.posix_fadvise(fd_src, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            remaining = os.fstat(fd_src).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(fd_src, fd_dst, remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+    except OSError:
+        return shutil.copy2(src, dst)
+    if remaining > 0:
+        # Some FUSE, overlay and network filesystems return 0 before the end: copy normally
+        # rather than leave a truncated archive behind.
+        return shutil.copy2(src, dst)
+    shutil.copystat(src, dst)
+    return dst
+
+
+def _clone_file(src, dst):
+    """A copy_function for shutil.copytree, which clones the file on copy-on-write filesystems
+    (btrfs, xfs, ...), so that no data block is copied. Falls back to _copy_file.
+    """
+    try:
+        with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+            fcntl.ioctl(f_dst.fileno(), _FICLONE, f_src.fileno())
+    except OSError:
+        return _copy_file(src, dst)
+    shutil.copystat(src, dst)
+    return dst
+
+
+def _parallel_copytree(
+        src: Path, dst: Path, copy_function=shutil.copy2, workers: int = 8
+):
+    """Like shutil.copytree, but the files are copied in a thread pool, so that the I/O of the
+    many small archive files overlaps.
+    """
+    dirs = []  # (src, dst) pairs, whose stats are copied once their content is in place
+    files = []
+
+    def walk(src_dir, dst_dir):
+        os.mkdir(dst_dir)
+        dirs.append((src_dir, dst_dir))
+        with os.scandir(src_dir) as it:
+            for entry in it:
+                target = os.path.join(dst_dir, entry.name)
+                if entry.is_dir():
+                    walk(entry.path, target)
+                else:
+                    files.append((entry.path, target))
+
+    walk(src, dst)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(copy_function, s, d) for s, d in files]
+    for future in futures:
+        future.result()
+    for src_dir, dst_dir in reversed(dirs):
+        shutil.copystat(src_dir, dst_dir)
+    return dst
+
+
+def _replace_dir(src: Path, dst: Path):
+    """Moves src to dst, replacing an existing dst.
+
+    The old dst is first renamed out of the way, so that the move itself is a couple of renames
+    (on the same filesystem), and the old tree is deleted in the background.
+    """
+    stale = None
+    if dst.exists():
+        stale = dst.with_name(dst.name + '.old')
+        if stale.exists():
+            shutil.rmtree(stale)
+        os.rename(dst, stale)
+    shutil.move(src, dst)
+    if stale is not None:
+        _bg_pool.submit(shutil.rmtree, stale, ignore_errors=True)
+
+
+def _start_local_archives(profile: Profile, u_folder: Path) -> typing.Optional[Path]:
+    """Copies the local archives to .unison, and returns their folder (None if there is none)."""
+    local_archive_f = profile.data_folder / LOCAL_ARC_NAME
+    if not local_archive_f.exists():
+        info(f'No local archive files found.')
+        u_folder.mkdir()  # creates empty ~/.unison
+        return None
+    # copy all files under local to .unison
+    copy_function = _copy_file
+    if _CAN_CLONE and _same_fs(local_archive_f, u_folder.parent):
+        copy_function = _clone_file
+    _parallel_copytree(local_archive_f, u_folder, copy_function=copy_function)
+    info(f'Copied archives in "{local_archive_f}" to "{u_folder}"')
+    return local_archive_f
+
+
+def _start_remote_archives(profile: Profile) -> typing.Optional[Path]:
+    """Copies the remote archives to remote's .unison, and returns their folder (None if there
+    is none).
+    """
+    remote_archive_f = profile.data_folder / REMOTE_ARC_NAME
+    if not remote_archive_f.exists():
+        info(f'No remote archive files found.')
+        # Note: note need to create an empty remote unison directory here.
+        return None
+    remote_ssh = profile.remote_ssh
+    remote_ssh.copy_archive_folder_to_remote_unison(remote_archive_f)
+    info(f'Copied remote archive in "{remote_archive_f}" to'
+         f' "{remote_ssh.remote_unison}" on "{profile.remote_name}"')
+    return remote_archive_f
+
+
+def _backup_archives(archive_f: Path, backup_f: Path):
+    backup_f.mkdir(parents=True, exist_ok=True)
+    backup_archive_f = backup_f / archive_f.name
+    _replace_dir(archive_f, backup_archive_f)
+    info(f'Moved archives in "{archive_f}" to "{backup_archive_f}" (backup)')
+
+
 def restore(profile: Profile):
-    u_folder = Path('~/.unison').expanduser()
-    if u_folder.exists() and u_folder.is_dir():
-        pass
-    else:
+    u_folder = _U_FOLDER
+    try:  # a single stat answers both "exists" and "is a folder"
+        u_folder_is_dir = stat.S_ISDIR(os.stat(u_folder).st_mode)
+    except FileNotFoundError:
+        u_folder_is_dir = False
+    if not u_folder_is_dir:
         error(f'Cannot found "{u_folder}" folder locally.')
         return -1
     profile_file_in_u = u_folder / profile.cfg_file.name
-    if not profile_file_in_u.exists():
+    try:
+        os.lstat(profile_file_in_u)
+    except FileNotFoundError:
         error(
             f'Profile file "{profile.cfg_file.name}" not found in "{u_folder}". Check why! Quit.'
         )
         return -1
 
-    # First, copy back local archives
+    # The local and remote archives are independent, so they are copied back concurrently.
+    tasks = [lambda: _restore_local_archives(profile, u_folder, profile_file_in_u)]
+    if profile.contain_remote:
+        tasks.append(lambda: _restore_remote_archives(profile))
+    _run_in_parallel(*tasks)
+    # Only once both are back: after a failure, the remote unison folder has not been replaced.
+    if profile.contain_remote:
+        _restore_remote_unison(profile)
+
+
+def _restore_local_archives(profile: Profile, u_folder: Path, profile_file_in_u: Path):
+    # Copy back local archives
     profile_file_in_u.unlink()  # Clear local unison cfg file, as it is a copy and clutters the unison directory.
     # everything under ~/.unison are archives now.
     local_archive = profile.data_folder / LOCAL_ARC_NAME
     shutil.move(u_folder, local_archive)
     info(f'Moved local archives back to "{local_archive}".')
-    u_backup_folder = Path(f'~/{UNISON_BACKUP_NAME}').expanduser()
+    # ~/.unison is free now, so the backup goes back at once, even if the remote side fails.
+    u_backup_folder = _U_BACKUP_FOLDER
     if u_backup_folder.exists():
         shutil.move(u_backup_folder, u_folder)
         info(f'Restored local backup "{u_backup_folder}" to "{u_folder}"')
 
-    if profile.contain_remote:
-        # Then, copy back remote archives
-        remote_ssh = profile.remote_ssh
-        remote_archive = profile.data_folder / REMOTE_ARC_NAME
-        profile.remote_ssh.copy_remote_archives_back(remote_archive)
-        info(f'Moved remote archives back to "{remote_archive}".')
-        if remote_ssh.unison_backup_exists():
-            # Note: we move existing .unison folder before restoring backup, since
-            # on certain OS (Window!), existing .unison folder would prevent
-            # the move command next line.
-            remote_ssh.delete_remote_unison()
-            remote_ssh.move_remote_backup_to_unison()
-            info(
-                f'Restored "{remote_ssh.remote_backup}" to "{remote_ssh.remote_unison}"'
-                f' on the remote "{profile.remote_name}"')
-        else:
-            remote_ssh.delete_remote_unison()
-            info(f'Deleted "{remote_ssh.remote_unison}" on "{profile.remote_name}"')
+
+def _restore_remote_archives(profile: Profile):
+    # Copy back remote archives
+    remote_archive = profile.data_folder / REMOTE_ARC_NAME
+    profile.remote_ssh.copy_remote_archives_back(remote_archive)
+    info(f'Moved remote archives back to "{remote_archive}".')
+
+
+def _restore_remote_unison(profile: Profile):
+    remote_ssh = profile.remote_ssh
+    # Note: the existing .unison folder is deleted before the backup is moved back, since on
+    # certain OS (Window!), an existing .unison folder would prevent the move.
+    if remote_ssh.restore_remote_unison():
+        info(
+            f'Restored "{remote_ssh.remote_backup}" to "{remote_ssh.remote_unison}"'
+            f' on the remote "{profile.remote_name}"')
+    else:
+        info(f'Deleted "{remote_ssh.remote_unison}" on "{profile.remote_name}"')
 
 
 def main():
@@ -539,12 +934,24 @@ def main():
         error(f"Invalid profile file: {profile_file}. Error: {e}")
         return -1
 
-    if option == 'start':
-        return start(profile)
-    if option == 'restore':
-        return restore(profile)
-    error(f'Invalid option: {option}')
-    return -1
+    try:
+        if option == 'start':
+            return start(profile)
+        if option == 'restore':
+            return restore(profile)
+        error(f'Invalid option: {option}')
+        return -1
+    except BaseException:
+        # The cached facts (e.g. the home folder) may be what is out of date: probe again next time.
+        # Also on Ctrl-C, or any other error, as the README promises.
+        if profile.remote_name is not None:
+            _write_cached_facts(profile.remote_name, None)
+        raise
+    finally:
+        # The "DONE" message is already out; wait for the background clean-ups to finish.
+        _bg_pool.shutdown(wait=True)
+        if profile.remote_ssh is not None:
+            profile.remote_ssh.close()
 
 
 if __name__ == '__main__':
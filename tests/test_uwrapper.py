@@ -0,0 +1,444 @@
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import PurePosixPath, PureWindowsPath
+
+import pytest
+
+import uwrapper
+from uwrapper import (
+    Root, RemoteSSHUnix, RemoteSSHWindows, _parse_root_path, _read_root_specs, read_profile
+)
+
+
+def _write_profile(tmp_path, content: bytes, name='p.prf'):
+    profile_file = tmp_path / name
+    profile_file.write_bytes(content)
+    return profile_file
+
+
+# %% Root specs
+
+@pytest.mark.parametrize('spec, expected', [
+    ('/home/xx/', Root('/home/xx/', True)),
+    ('ssh://remote//home/xx/', Root('/home/xx/', False, 'remote', 'Unix')),
+    ('ssh://u@remote//home/xx/', Root('/home/xx/', False, 'u@remote', 'Unix')),
+    ('ssh://wr/d:\\Users\\hc\\code\\', Root('d:\\Users\\hc\\code\\', False, 'wr', 'Windows')),
+    ('ssh://wr/C:/Users/hc', Root('C:/Users/hc', False, 'wr', 'Windows')),
+])
+def test_parse_root_path(spec, expected):
+    assert _parse_root_path(spec) == expected
+
+
+@pytest.mark.parametrize('spec', [
+    'socket://localhost:1234//home/xx',
+    'rsh://remote//home/xx',
+    'ssh://remote',
+    'ssh://remote/',
+    'ssh://remote/home/xx',  # neither absolute nor a drive
+])
+def test_parse_root_path_rejects(spec):
+    with pytest.raises(ValueError):
+        _parse_root_path(spec)
+
+
+# %% Profile scanning
+
+def test_read_root_specs(tmp_path):
+    profile_file = _write_profile(
+        tmp_path, b'# root = /commented\nroot = /a\n  root = /indented\nroot=ssh://h//b\n'
+    )
+    assert _read_root_specs(profile_file) == ['/a', 'ssh://h//b']
+
+
+def test_read_root_specs_first_line(tmp_path):
+    profile_file = _write_profile(tmp_path, b'root=/a\nroot=/b')
+    assert _read_root_specs(profile_file) == ['/a', '/b']
+
+
+def test_read_root_specs_crlf(tmp_path):
+    profile_file = _write_profile(tmp_path, b'root = /a\r\nroot =\tssh://h//b  \r\n')
+    assert _read_root_specs(profile_file) == ['/a', 'ssh://h//b']
+
+
+def test_read_root_specs_does_not_span_lines(tmp_path):
+    profile_file = _write_profile(tmp_path, b'root=\n/a\nroot =\n/x\nroot = /b\n')
+    assert _read_root_specs(profile_file) == ['/b']
+
+
+def test_read_root_specs_large_file(tmp_path):
+    # Large enough to be memory-mapped, with the roots past the first page.
+    padding = b'# ' + b'x' * 100 + b'\n'
+    content = padding * (2 * uwrapper.MMAP_MIN_SIZE // len(padding)) + b'root = /a\nroot = /b\n'
+    profile_file = _write_profile(tmp_path, content)
+    assert profile_file.stat().st_size >= uwrapper.MMAP_MIN_SIZE
+    assert _read_root_specs(profile_file) == ['/a', '/b']
+
+
+def test_read_root_specs_stops_after_third_root(tmp_path):
+    profile_file = _write_profile(tmp_path, b''.join(b'root = /r%d\n' % i for i in range(5)))
+    assert _read_root_specs(profile_file) == ['/r0', '/r1', '/r2']
+
+
+def test_read_root_specs_utf8(tmp_path):
+    profile_file = _write_profile(tmp_path, 'root = /données\nroot = /b\n'.encode('utf-8'))
+    assert _read_root_specs(profile_file) == ['/données', '/b']
+
+
+# %% Profiles
+
+def test_read_profile_local(tmp_path):
+    profile = read_profile(_write_profile(tmp_path, b'root = /a\nroot = /b\n'))
+    assert profile.roots == (Root('/a', True), Root('/b', True))
+    assert not profile.contain_remote
+    assert profile.remote_ssh is None
+    assert profile.data_folder == tmp_path / 'p'
+    assert profile.data_folder.is_dir()
+
+
+def test_read_profile_unix_remote(tmp_path):
+    profile = read_profile(_write_profile(tmp_path, b'root = /a\nroot = ssh://u@h//b\n'))
+    assert profile.contain_remote
+    assert profile.remote_name == 'u@h'
+    assert profile.remote_root == Root('/b', False, 'u@h', 'Unix')
+    assert isinstance(profile.remote_ssh, RemoteSSHUnix)
+
+
+def test_read_profile_windows_remote(tmp_path):
+    profile = read_profile(_write_profile(tmp_path, b'root = ssh://w/d:\\code\nroot = /a\n'))
+    assert profile.remote_root == Root('d:\\code', False, 'w', 'Windows')
+    assert isinstance(profile.remote_ssh, RemoteSSHWindows)
+
+
+@pytest.mark.parametrize('content', [
+    b'root = /a\n',
+    b'root = /a\nroot = /b\nroot = /c\n',
+    b'root = ssh://h//a\nroot = ssh://h//b\n',
+])
+def test_read_profile_rejects_roots(tmp_path, content):
+    with pytest.raises(RuntimeError):
+        read_profile(_write_profile(tmp_path, content))
+
+
+def test_read_profile_rejects_extension(tmp_path):
+    with pytest.raises(RuntimeError):
+        read_profile(_write_profile(tmp_path, b'root = /a\nroot = /b\n', name='p.txt'))
+
+
+def _stub_remote(remote_cls, output: str, home='/home/u'):
+    """A remote whose execute() returns output, recording the commands it was given."""
+    remote = remote_cls('h')
+    home_cls = PurePosixPath if remote_cls is RemoteSSHUnix else PureWindowsPath
+    remote.__dict__['remote_home'] = home_cls(home)  # no facts lookup
+    remote.commands = []
+
+    def execute(cmd):
+        remote.commands.append(cmd)
+        return output
+
+    remote.execute = execute
+    return remote
+
+
+def test_query_facts():
+    remote = _stub_remote(RemoteSSHUnix, '/home/u\n')
+    assert remote._query_facts() == {'home': '/home/u'}
+    assert len(remote.commands) == 1
+
+
+@pytest.mark.parametrize('remote_cls, output, expected', [
+    (RemoteSSHUnix, 'no no skip\n', (False, False)),
+    (RemoteSSHUnix, 'yes no yes\n', (True, False)),
+    (RemoteSSHUnix, 'no yes skip\n', (False, True)),
+    (RemoteSSHUnix, 'yes yes skip\n', (True, True)),
+    (RemoteSSHWindows, 'False False skip\r\n', (False, False)),
+    (RemoteSSHWindows, 'True False True\r\n', (True, False)),
+    (RemoteSSHWindows, 'False True skip\r\n', (False, True)),
+    (RemoteSSHWindows, 'True True skip\r\n', (True, True)),
+])
+def test_backup_remote_unison(remote_cls, output, expected):
+    remote = _stub_remote(remote_cls, output)
+    assert remote.backup_remote_unison() == expected
+    assert len(remote.commands) == 1
+
+
+@pytest.mark.parametrize('remote_cls, output', [
+    (RemoteSSHUnix, 'yes no no\n'),
+    (RemoteSSHWindows, 'Rename-Item : Access to the path is denied.\r\nTrue False False\r\n'),
+])
+def test_backup_remote_unison_failed_move(remote_cls, output):
+    with pytest.raises(RuntimeError, match='Failed to move'):
+        _stub_remote(remote_cls, output).backup_remote_unison()
+
+
+@pytest.mark.parametrize('remote_cls, output, error', [
+    (RemoteSSHUnix, '', RuntimeError),
+    (RemoteSSHUnix, 'yes no\n', RuntimeError),
+    (RemoteSSHUnix, 'Welcome!\nyes no yes\n', RuntimeError),
+    (RemoteSSHWindows, '', ValueError),
+    (RemoteSSHWindows, 'yes no yes\r\n', ValueError),
+])
+def test_backup_remote_unison_unexpected_output(remote_cls, output, error):
+    with pytest.raises(error):
+        _stub_remote(remote_cls, output).backup_remote_unison()
+
+
+@pytest.mark.parametrize('remote_cls', [RemoteSSHUnix, RemoteSSHWindows])
+@pytest.mark.parametrize('output, restored', [('restored\n', True), ('deleted\n', False)])
+def test_restore_remote_unison(remote_cls, output, restored):
+    remote = _stub_remote(remote_cls, output)
+    assert remote.restore_remote_unison() is restored
+    assert len(remote.commands) == 1
+
+
+@pytest.mark.parametrize('remote_cls', [RemoteSSHUnix, RemoteSSHWindows])
+@pytest.mark.parametrize('output, message', [
+    ('rmfail\n', 'Failed to remove'), ('mvfail\n', 'Failed to move'),
+])
+def test_restore_remote_unison_failures(remote_cls, output, message):
+    with pytest.raises(RuntimeError, match=message):
+        _stub_remote(remote_cls, output).restore_remote_unison()
+
+
+def test_restore_remote_unison_after_windows_errors():
+    output = 'Remove-Item : Cannot find path.\r\nAt line:1 char:1\r\ndeleted\r\n'
+    assert _stub_remote(RemoteSSHWindows, output).restore_remote_unison() is False
+
+
+@pytest.mark.parametrize('remote_cls, output, error', [
+    (RemoteSSHUnix, '', RuntimeError),
+    (RemoteSSHUnix, 'rm: cannot remove\ndeleted\n', RuntimeError),
+    (RemoteSSHWindows, '', ValueError),
+    (RemoteSSHWindows, 'True\r\n', ValueError),
+])
+def test_restore_remote_unison_unexpected_output(remote_cls, output, error):
+    with pytest.raises(error):
+        _stub_remote(remote_cls, output).restore_remote_unison()
+
+
+# %% Remote facts cache
+
+@pytest.fixture
+def cache_file(tmp_path, monkeypatch):
+    cache_file = tmp_path / 'cache' / 'remotes.json'
+    monkeypatch.setattr(uwrapper, 'REMOTE_CACHE_FILE', cache_file)
+    monkeypatch.delenv(uwrapper.NO_CACHE_ENV, raising=False)
+    return cache_file
+
+
+def test_cached_facts_hit(cache_file):
+    uwrapper._write_cached_facts('h', {'home': '/home/u'})
+    uwrapper._write_cached_facts('w', {'home': 'C:\\Users\\u'})
+    facts = uwrapper._read_cached_facts('h', ('home',))
+    assert facts['home'] == '/home/u'
+
+
+def test_cached_facts_miss(cache_file):
+    assert uwrapper._read_cached_facts('h', ('home',)) is None  # no cache file yet
+    uwrapper._write_cached_facts('h', {'home': '/home/u'})
+    assert uwrapper._read_cached_facts('other', ('home',)) is None
+    assert uwrapper._read_cached_facts('h', ('home', 'shell')) is None
+
+
+def test_cached_facts_expiry(cache_file, monkeypatch):
+    uwrapper._write_cached_facts('h', {'home': '/home/u'})
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + uwrapper.REMOTE_CACHE_TTL - 1)
+    assert uwrapper._read_cached_facts('h', ('home',)) is not None
+    monkeypatch.setattr(time, 'time', lambda: now + uwrapper.REMOTE_CACHE_TTL + 1)
+    assert uwrapper._read_cached_facts('h', ('home',)) is None
+
+
+@pytest.mark.parametrize('content', ['{not json', '[1, 2]', '{"h": "/home/u"}', '{"h": {}}'])
+def test_cached_facts_corrupt_file(cache_file, content):
+    cache_file.parent.mkdir()
+    cache_file.write_text(content)
+    assert uwrapper._read_cached_facts('h', ('home',)) is None
+    uwrapper._write_cached_facts('h', {'home': '/home/u'})  # overwrites the corrupt file
+    assert uwrapper._read_cached_facts('h', ('home',))['home'] == '/home/u'
+
+
+def test_cached_facts_drop(cache_file):
+    uwrapper._write_cached_facts('h', {'home': '/home/u'})
+    uwrapper._write_cached_facts('w', {'home': 'C:\\Users\\u'})
+    uwrapper._write_cached_facts('h', None)
+    assert uwrapper._read_cached_facts('h', ('home',)) is None
+    assert uwrapper._read_cached_facts('w', ('home',)) is not None
+
+
+def test_lookup_facts_no_cache(cache_file, monkeypatch):
+    uwrapper._write_cached_facts('h', {'home': '/old/home'})
+    monkeypatch.setenv(uwrapper.NO_CACHE_ENV, '1')
+    remote = _stub_remote(RemoteSSHUnix, '/new/home\n')
+    assert remote._lookup_facts(remote._query_facts)['home'] == '/new/home'
+    assert len(remote.commands) == 1
+    monkeypatch.delenv(uwrapper.NO_CACHE_ENV)
+    assert uwrapper._read_cached_facts('h', ('home',))['home'] == '/new/home'  # written back
+
+
+def test_lookup_facts_ttl(cache_file, monkeypatch):
+    remote = _stub_remote(RemoteSSHUnix, '/home/u\n')
+    remote._lookup_facts(remote._query_facts)
+    remote._lookup_facts(remote._query_facts)
+    assert len(remote.commands) == 1  # the second lookup is a cache hit
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + uwrapper.REMOTE_CACHE_TTL + 1)
+    remote._lookup_facts(remote._query_facts)
+    assert len(remote.commands) == 2
+
+
+@pytest.mark.parametrize('exc', [KeyboardInterrupt, RuntimeError, OSError])
+def test_main_drops_cached_facts_on_failure(tmp_path, cache_file, monkeypatch, exc):
+    uwrapper._write_cached_facts('h', {'home': '/home/u'})
+    uwrapper._write_cached_facts('other', {'home': '/home/o'})
+    profile_file = _write_profile(tmp_path, b'root = /a\nroot = ssh://h//b\n')
+    monkeypatch.setattr(sys, 'argv', ['uwrapper', 'start', str(profile_file)])
+    monkeypatch.setattr(uwrapper, '_bg_pool', ThreadPoolExecutor(max_workers=1))
+
+    def start(profile):
+        raise exc()
+
+    monkeypatch.setattr(uwrapper, 'start', start)
+    with pytest.raises(exc):
+        uwrapper.main()
+    assert uwrapper._read_cached_facts('h', ('home',)) is None
+    assert uwrapper._read_cached_facts('other', ('home',)) is not None
+
+
+# %% Local copies
+
+@pytest.mark.skipif(not hasattr(os, 'copy_file_range'), reason='needs os.copy_file_range')
+def test_copy_file_falls_back_after_short_copy(tmp_path, monkeypatch):
+    src, dst = tmp_path / 'ar1', tmp_path / 'ar1.copy'
+    src.write_bytes(bytes(range(256)) * 64)
+    counts = iter([100, 0])
+
+    def short_copy_file_range(fd_src, fd_dst, count):
+        # Copies fewer bytes than asked for, then stops early, like some FUSE filesystems.
+        n = next(counts)
+        os.write(fd_dst, os.read(fd_src, n))
+        return n
+
+    monkeypatch.setattr(os, 'copy_file_range', short_copy_file_range)
+    uwrapper._copy_file(src, dst)
+    assert next(counts, None) is None
+    assert dst.read_bytes() == src.read_bytes()
+
+
+def test_parallel_copytree(tmp_path):
+    src = tmp_path / 'src'
+    (src / 'sub' / 'deeper').mkdir(parents=True)
+    for i, rel in enumerate(['ar1', 'fp1', 'sub/ar2', 'sub/deeper/ar3']):
+        (src / rel).write_bytes(b'%d' % i * 1000)
+    os.utime(src / 'sub', (1_000_000, 1_000_000))
+    dst = tmp_path / 'dst'
+
+    assert uwrapper._parallel_copytree(src, dst, copy_function=uwrapper._copy_file) == dst
+    copied = sorted(p.relative_to(dst) for p in dst.rglob('*'))
+    assert copied == sorted(p.relative_to(src) for p in src.rglob('*'))
+    for rel in copied:
+        if (src / rel).is_file():
+            assert (dst / rel).read_bytes() == (src / rel).read_bytes()
+    # Directory stats are copied once the files are in, so they are not bumped afterwards.
+    assert (dst / 'sub').stat().st_mtime == 1_000_000
+
+
+def test_replace_dir_without_existing_dst(tmp_path):
+    src, dst = tmp_path / 'archives_local', tmp_path / 'backup'
+    src.mkdir()
+    (src / 'ar1').write_bytes(b'new')
+    uwrapper._replace_dir(src, dst)
+    assert not src.exists()
+    assert (dst / 'ar1').read_bytes() == b'new'
+    assert not (tmp_path / 'backup.old').exists()
+
+
+def test_replace_dir_swaps_existing_dst(tmp_path, monkeypatch):
+    bg_pool = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(uwrapper, '_bg_pool', bg_pool)
+    src, dst, stale = tmp_path / 'archives_local', tmp_path / 'backup', tmp_path / 'backup.old'
+    for folder, content in [(src, b'new'), (dst, b'old'), (stale, b'older')]:
+        folder.mkdir()
+        (folder / 'ar1').write_bytes(content)
+
+    uwrapper._replace_dir(src, dst)
+    bg_pool.shutdown(wait=True)
+    assert not src.exists()
+    assert os.listdir(dst) == ['ar1']
+    assert (dst / 'ar1').read_bytes() == b'new'
+    assert not stale.exists()
+
+
+class _DeferredPool:
+    """Records the submitted calls instead of running them, like a busy _bg_pool."""
+    def __init__(self):
+        self.calls = []
+
+    def submit(self, fn, *args, **kwargs):
+        self.calls.append((fn, args, kwargs))
+
+
+def test_replace_dir_deletes_stale_dst_in_background(tmp_path, monkeypatch):
+    bg_pool = _DeferredPool()
+    monkeypatch.setattr(uwrapper, '_bg_pool', bg_pool)
+    src, dst = tmp_path / 'archives_local', tmp_path / 'backup'
+    src.mkdir()
+    (dst / 'sub').mkdir(parents=True)
+
+    uwrapper._replace_dir(src, dst)
+    stale = tmp_path / 'backup.old'
+    assert (stale / 'sub').is_dir()  # not deleted on the caller's thread
+    assert len(bg_pool.calls) == 1
+    fn, args, kwargs = bg_pool.calls[0]
+    fn(*args, **kwargs)
+    assert not stale.exists()
+
+
+# %% Restore
+
+class _FailingRemote:
+    def copy_remote_archives_back(self, archive_folder):
+        raise RuntimeError('copy-back failed')
+
+    def restore_remote_unison(self):
+        raise AssertionError('the remote unison folder must not be replaced after a failure')
+
+
+def test_restore_puts_local_backup_back_when_remote_fails(tmp_path, monkeypatch):
+    u_folder, u_backup_folder = tmp_path / '.unison', tmp_path / uwrapper.UNISON_BACKUP_NAME
+    monkeypatch.setattr(uwrapper, '_U_FOLDER', u_folder)
+    monkeypatch.setattr(uwrapper, '_U_BACKUP_FOLDER', u_backup_folder)
+    profile_file = _write_profile(tmp_path, b'root = /a\nroot = ssh://h//b\n')
+    u_folder.mkdir()
+    (u_folder / 'ar1').write_bytes(b'archive')
+    (u_folder / profile_file.name).write_bytes(profile_file.read_bytes())
+    u_backup_folder.mkdir()
+    (u_backup_folder / 'before').write_bytes(b'user data')
+    profile = uwrapper.Profile(
+        cfg_file=profile_file, data_folder=tmp_path / 'p', roots=(Root('/a', True),) * 2,
+        contain_remote=True, remote_name='h', remote_root=None, remote_ssh=_FailingRemote(),
+    )
+    profile.data_folder.mkdir()
+
+    with pytest.raises(RuntimeError, match='copy-back failed'):
+        uwrapper.restore(profile)
+    assert (u_folder / 'before').read_bytes() == b'user data'
+    assert not u_backup_folder.exists()
+    assert (profile.data_folder / uwrapper.LOCAL_ARC_NAME / 'ar1').read_bytes() == b'archive'
+
+
+# %% Remotes
+
+def test_ssh_opts_create_control_folder(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    remote = RemoteSSHUnix('h')
+    assert 'ControlPath=~/.ssh/uwrapper-%C' in remote._ssh_opts
+    assert (tmp_path / '.ssh').stat().st_mode & 0o777 == 0o700
+
+
+def test_close_without_connection(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setattr(uwrapper, 'call', lambda *args, **kwargs: pytest.fail('ssh was called'))
+    RemoteSSHUnix('h').close()
+    assert not (tmp_path / '.ssh').exists()